@@ -19,6 +19,19 @@ def tlmatchfn(names):
 class TooManyTemplates(Exception):
     pass
 
+class TemplateIndex(object):
+    # All the templates in a parse tree, found in a single pass.  This
+    # can be used in place of the tree by anything that looks templates
+    # up with tlgetall(), which saves walking the whole tree for each
+    # lookup.  It goes stale if the tree is modified.
+    def __init__(self, tree):
+        self.templates = tree.filter_templates()
+    def filter_templates(self, matches):
+        return [tl for tl in self.templates if matches(tl)]
+
+def index_templates(tree):
+    return TemplateIndex(tree)
+
 def tlgetall(tree, names):
     return tree.filter_templates(matches = tlmatchfn(names))
 
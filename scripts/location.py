@@ -1,5 +1,6 @@
 from __future__ import division, print_function, unicode_literals
 
+from functools import lru_cache
 import pyproj
 
 import mwparserfromhell
@@ -69,14 +70,26 @@ def igr_from_en(e, n, digits):
     nstr = "{:05d}".format(n%100000)[:int(digits//2)]
     return letter + estr + nstr
 
+# Keep the connection to MapIt alive between requests.
+mapit_session = requests.Session()
+
+# Areas don't move, so there's no need to ask MapIt about the same
+# point twice.
+@lru_cache(maxsize=4096)
+def mapit_areas(latstr, lonstr):
+    r = mapit_session.get('http://global.mapit.mysociety.org'
+                          '/point/4326/{},{}'.format(lonstr,latstr))
+    r.raise_for_status()
+    return r.json()
+
 class MapItSettings(object):
     def __init__(self, allowed=False):
         self.allowed = allowed
         self.used = False
 
-def region_of(grid, e, n, latstr, lonstr, mapit = None):
-    # First, see if it's obvious.  Look for a myriad wholly within a single
-    # region (including territorial waters).
+def obvious_region(grid, e, n):
+    # Look for a myriad wholly within a single region (including
+    # territorial waters).
     myriad = None
     if grid == bng:
         myriad = bngr_from_en(e, n, 0)
@@ -87,12 +100,15 @@ def region_of(grid, e, n, latstr, lonstr, mapit = None):
             return 'GB-ENG'
     if grid == ig:
         if igr_from_en(e, n, 0) in ('M', 'N', 'R', 'S'): return 'IE'
+    return None
+
+def region_of(grid, e, n, latstr, lonstr, mapit = None):
+    # First, see if it's obvious.
+    region = obvious_region(grid, e, n)
+    if region != None: return region
 
     if mapit and mapit.allowed:
-        r = requests.get('http://global.mapit.mysociety.org'
-                         '/point/4326/{},{}'.format(lonstr,latstr))
-        r.raise_for_status()
-        j = r.json()
+        j = mapit_areas(latstr, lonstr)
         for area in j.values():
             if 'codes' in area and 'iso3166_1' in area['codes']:
                 mapit.used = True
@@ -231,6 +247,27 @@ def camera_statement_from_row(row):
     s = statement_from_grid(grid, e, n, digits, heading, use6fig)
     return s
 
+def mapit_points_from_row(row):
+    # Points that location_from_row() and object_location_from_row()
+    # might ask MapIt about, as (latstr, lonstr) for mapit_areas().
+    points = []
+    camera_grid = camera_grid_from_row(row)
+    # location_from_row() doesn't do 1km camera locations.
+    if camera_grid != None and camera_grid[3] == 4: camera_grid = None
+    object_grid = object_grid_from_row(row)
+    # object_location_from_row() doesn't do 1km object locations if
+    # there's a camera location.
+    if object_grid[3] == 4 and camera_grid != None: object_grid = None
+    for grid_info in (camera_grid, object_grid):
+        if grid_info == None: continue
+        grid, e, n, digits, heading, use6fig = grid_info
+        if obvious_region(grid, e, n) == None:
+            latstr, lonstr, prec = latlon_from_grid(grid, e, n, digits,
+                                                    use6fig)
+            if (latstr, lonstr) not in points:
+                points.append((latstr, lonstr))
+    return points
+
 def object_grid_from_row(row):
     # The "subject location" in Geograph isn't necessarily the main
     # subject of the image:
@@ -469,9 +506,15 @@ def location_params(template):
     paramdict = { }
     try:
         paramstr = template.get(3).value
+        # The result is remembered on the template, and is good as
+        # long as parameter 3 hasn't been replaced.
+        cached = getattr(template, '_gub_params', None)
+        if cached != None and cached[0] is paramstr:
+            return cached[1]
         for x in paramstr.split('_'):
             k, _, v = x.partition(':')
             paramdict[k] = v
+        template._gub_params = (paramstr, paramdict)
     except AttributeError:
         # Probably passed None
         pass
@@ -479,4 +522,16 @@ def location_params(template):
         # Probably parameter not found
         pass
     return paramdict
+
+# Source parameter of a location template added from Geograph:
+# "geograph" or "geograph-<something>".  This is what
+# re.match(r'^geograph(-|$)', source) accepts, including the trailing
+# newline that "$" allows, without the regex.
+def is_geograph_source(source):
+    return (source.startswith('geograph') and
+            (source[8:] in ('', '\n') or source[8] == '-'))
+
+def location_prec(template):
+    # The "prec=" parameter, in metres, as set by location_from_grid().
+    return int(str(template.get('prec').value).strip())
     
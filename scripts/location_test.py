@@ -1,7 +1,7 @@
 from __future__ import division, print_function, unicode_literals
 
 import unittest
-from gubutil import tlgetone
+from gubutil import tlgetone, index_templates
 from location import (bng, ig, location_from_grid, statement_from_grid,
                       location_from_row, object_location_from_row,
                       camera_statement_from_row,
@@ -9,9 +9,12 @@ from location import (bng, ig, location_from_grid, statement_from_grid,
                       en_from_gr, bngr_from_en, format_row,
                       set_location, set_object_location,
                       get_location, get_object_location,
-                      statement_matches_template)
+                      statement_matches_template, location_prec,
+                      location_params, is_geograph_source,
+                      mapit_points_from_row)
 import mwparserfromhell
 from mwparserfromhell.nodes.template import Template
+import re
 
 class FromGridTests(unittest.TestCase):
     def test_from_grid(self):
@@ -92,6 +95,30 @@ class FromRowTests(unittest.TestCase):
             "{{Location|51.71051|-2.2766|"
             "source:geograph-osgb36(SO80980134)_region:GB-EAW_heading:292|"
             "prec=100}}")
+    def test_full_row_prec(self):
+        self.assertEqual(location_prec(location_from_row(self.full_row)), 100)
+    def test_full_row_params(self):
+        t = location_from_row(self.full_row)
+        self.assertEqual(location_params(t)['heading'], '292')
+        t.add(3, 'source:geograph-osgb36(SO80980134)_heading:293')
+        self.assertEqual(location_params(t)['heading'], '293')
+    def test_full_row_mapit(self):
+        self.assertEqual(mapit_points_from_row(self.full_row), [])
+    def test_low_row_mapit(self):
+        self.assertEqual(mapit_points_from_row(self.low_row),
+                         [('55.174', '-4.93')])
+    def test_medium_row_mapit(self):
+        self.assertEqual(mapit_points_from_row(self.mid_row),
+                         [('51.9360', '-9.152')])
+    def test_nx_high_row_mapit(self):
+        # 1km object location isn't used when there's a camera location.
+        row = dict(self.high_row, grid_reference='NX1390',
+                   viewpoint_eastings=213000, viewpoint_northings=590000)
+        self.assertEqual(mapit_points_from_row(row),
+                         [('55.168864', '-4.93755')])
+        self.assertEqual(str(location_from_row(row)),
+            "{{Location|55.168864|-4.93755|"
+            "source:geograph-osgb36(NX1300090000)|prec=1}}")
     def test_full_row_cstmt(self):
         s = camera_statement_from_row(self.full_row)
         self.assertEqual(s, {
@@ -182,6 +209,14 @@ class FromRowTests(unittest.TestCase):
         self.assertEqual(f,
             "subject SY8379")
 
+class SourceTests(unittest.TestCase):
+    def test_geograph_source(self):
+        for source in ('geograph', 'geograph-osgb36(SO80980134)',
+                       'geographx', 'geograph\n', 'geograph\n\n', ''):
+            self.assertEqual(is_geograph_source(source),
+                             bool(re.match(r'^geograph(-|$)', source)),
+                             repr(source))
+
 class EditingTest1(unittest.TestCase):
     def setUp(self):
         self.tree = mwparserfromhell.parse("{{Information}}\n{{location dec}}")
@@ -336,6 +371,11 @@ class SDCEqualityTests(unittest.TestCase):
         self.assertTrue(
             statement_matches_template(self.sdc['statements']['P1259'][0],
                                       get_location(self.templates)))
+    def test_match_camera_index(self):
+        self.assertTrue(
+            statement_matches_template(self.sdc['statements']['P1259'][0],
+                                      get_location(
+                                          index_templates(self.templates))))
     def test_match_object(self):
         self.assertTrue(
             statement_matches_template(self.sdc['statements']['P625'][0],
@@ -1,17 +1,13 @@
 from __future__ import division, print_function
 
 import pywikibot
-from pywikibot.bot import (
-    SingleSiteBot, ExistingPageBot, NoRedirectPageBot, AutomaticTWSummaryBot)
+from pywikibot.bot import SingleSiteBot, ExistingPageBot, NoRedirectPageBot
 import pywikibot.bot as bot
-import pywikibot.data.api as api
-import pywikibot.pagegenerators
-from pywikibot.pagegenerators import PreloadingGenerator
-from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from dateutil.tz import gettz
-from itertools import chain
+from itertools import islice
 import json
-from math import copysign
 import mwparserfromhell
 import re
 import sqlite3
@@ -21,11 +17,12 @@ from location import (location_from_row, object_location_from_row,
                       az_dist_between_locations, format_row,
                       format_direction, get_location, get_object_location,
                       set_location, set_object_location, location_params,
+                      location_prec, is_geograph_source,
+                      mapit_areas, mapit_points_from_row,
                       MapItSettings, statement_matches_template)
 
 from gubutil import (
-    get_gridimage_id, TooManyTemplates, tlgetone, NewGeographImages,
-    GeoGeneratorFactory)
+    get_gridimage_id, TooManyTemplates, GeoGeneratorFactory, index_templates)
 
 # Ways that Geograph locations get in:
 # BotMultichill (example?)
@@ -33,8 +30,33 @@ from gubutil import (
 # File Upload Bot (Magnus Manske)
 # Geograph2commons
 
+# Each row gets looked at a lot, by column name, and sqlite3.Row
+# finds columns by searching through them all.  A dict is quicker,
+# and the code in location and creditline takes either.
+def dict_factory(cursor, row):
+    return {d[0]: v for d, v in zip(cursor.description, row)}
+
 geodb = sqlite3.connect('geograph-db/geograph.sqlite3')
-geodb.row_factory = sqlite3.Row
+geodb.row_factory = dict_factory
+# We only ever read the database, but we read it a lot.
+for pragma in ("cache_size=-65536", "mmap_size=268435456",
+               "temp_store=MEMORY"):
+    geodb.execute("PRAGMA " + pragma)
+
+# Everything we want to know about a Geograph image.  Keeping the text
+# of the query constant lets sqlite3 re-use the compiled statement.
+georow_select = """
+    SELECT * FROM gridimage_base NATURAL JOIN gridimage_geo
+                  NATURAL JOIN gridimage_extra
+    """
+georow_query = georow_select + "WHERE gridimage_id = ?"
+
+# Quick and dirty way to find the Geograph ID without parsing the page.
+geograph_id_re = re.compile(
+    r'\{\{\s*(?:[Gg]eograph|[Aa]lso geograph)\s*\|\s*(\d+)\s*\|')
+
+# Geograph timestamps are in local time.
+geograph_tz = gettz("Europe/London")
 
 class NotEligible(Exception):
     pass
@@ -50,13 +72,27 @@ class MajorProblem(Exception):
     pass
 class BadGeographDatabase(MajorProblem):
     pass
+class PageChanged(Exception):
+    pass
 
 class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
     def __init__(self, generator, **kwargs):
         # call constructor of the super class
         super(UpdateMetadataBot, self).__init__(site=True, **kwargs)
+        # SDC statements for pages that have been through
+        # preload_batch() but not yet processed, keyed by page ID.
+        self._sdc_cache = {}
+        # IDs of pages in the current batch, in order, until we
+        # fetch their SDC statements.
+        self._sdc_pending = []
+        # Geograph database rows for the current batch, keyed by
+        # Geograph ID.
+        self._row_cache = {}
+        # Timestamps of the first revisions of pages in the current
+        # batch, keyed by page ID.
+        self._creation_times = {}
         # assign the generator to the bot
-        self.generator = generator
+        self.generator = self.preload_batch(generator)
     summary_formats = {
         # (camera_action, object_action)
         ('add', 'add'):
@@ -103,14 +139,22 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
         "Remove Geograph-derived 1km-precision object location",
         (None, None): ""
     }
+    def creation_time(self, page):
+        # The first revision can't be preloaded along with the latest
+        # one, so each lookup is an API request.  It won't change if
+        # we have to restart the edit, though.
+        if page.pageid not in self._creation_times:
+            self._creation_times[page.pageid] = (
+                page.oldest_revision.timestamp)
+        return self._creation_times[page.pageid]
     def unmodified_on_geograph_since_upload(self, page, row):
-        commons_dt = page.oldest_revision.timestamp
+        commons_dt = self.creation_time(page)
         # For some reason, pywikibot.Timestamps aren't timezone-aware.
         commons_dt = commons_dt.replace(tzinfo=timezone.utc)
         geograph_date = row['upd_timestamp']
-        geograph_dt = (
-            datetime.strptime(geograph_date, "%Y-%m-%d %H:%M:%S")
-            .replace(tzinfo=gettz("Europe/London")))
+        # Geograph's "%Y-%m-%d %H:%M:%S" is close enough to ISO 8601.
+        geograph_dt = (datetime.fromisoformat(geograph_date)
+                       .replace(tzinfo=geograph_tz))
         bot.log("Commons timestamp: %s; Geograph timestamp: %s" %
                 (commons_dt, geograph_dt))
         return geograph_dt < commons_dt
@@ -131,7 +175,7 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
             else:
                 (azon, azno, dist) = az_dist_between_locations(
                     old_template, new_template)
-                if dist < int(str(new_template.get('prec').value)):
+                if dist < location_prec(new_template):
                     bot.log("%s has only moved by %d m: not updating"
                             % (desc.capitalize(), dist))
                     should_set = False
@@ -147,20 +191,85 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
         azon, azno, distance = (
             az_dist_between_locations(old_template, new_template))
         return "moved %.1f m %s" % (distance, format_direction(azon))
-    def get_sdc_statements(self, page):
-        # SDC data aren't preloaded, so we make an API request every time.
-        # This could be better, wbgetentities can do batches of pages just
-        # like query.
-        mediaid = 'M%d' % (page.pageid,)
-        request = self.site._simple_request(action='wbgetentities',
-                                            ids=mediaid)
+    def preload_batch(self, generator, groupsize=50):
+        # SDC data aren't preloaded by PreloadingGenerator, so we
+        # fetch them ourselves.  wbgetentities can handle up to 50
+        # entities per request, so do that rather than making a
+        # request per page.  Most pages don't need SDC at all, so
+        # we wait until one does before making the request.  While
+        # we're at it, look up the whole batch in the Geograph
+        # database in one query.
+        generator = iter(generator)
+        while True:
+            pages = list(islice(generator, groupsize))
+            if not pages: return
+            # Anything left over from the last batch was skipped.
+            self._sdc_cache.clear()
+            self._row_cache.clear()
+            self._creation_times.clear()
+            self._sdc_pending = [page.pageid for page in pages
+                                 if page.pageid]
+            gridimage_ids = set()
+            for page in pages:
+                # This is only a hint: process_page() does the job
+                # properly and falls back to get_geograph_row().
+                m = geograph_id_re.search(page.text)
+                if m: gridimage_ids.add(int(m.group(1)))
+            if gridimage_ids:
+                c = geodb.execute(
+                    georow_select + "WHERE gridimage_id IN (%s)" %
+                    (','.join('?' * len(gridimage_ids)),),
+                    tuple(gridimage_ids))
+                for row in c:
+                    self._row_cache[row['gridimage_id']] = row
+            yield from pages
+    def get_geograph_row(self, gridimage_id):
+        try:
+            return self._row_cache[gridimage_id]
+        except KeyError:
+            pass
+        return geodb.execute(georow_query, (gridimage_id,)).fetchone()
+    def fetch_sdc(self, pageids):
+        mediaids = {'M%d' % (pageid,): pageid for pageid in pageids}
+        request = self.site._simple_request(
+            action='wbgetentities', ids='|'.join(mediaids), props='claims')
         data = request.submit()
-        return data['entities'][mediaid].get('statements', {})
-    def has_sdc_geocoding(self, page):
-        statements = self.get_sdc_statements(page)
+        for mediaid, pageid in mediaids.items():
+            entity = data['entities'].get(mediaid, {})
+            self._sdc_cache[pageid] = entity.get('statements', {})
+    def get_sdc_statements(self, page):
+        if page.pageid in self._sdc_pending:
+            # Earlier pages in the batch have already been processed,
+            # so only fetch this one and the ones after it.
+            i = self._sdc_pending.index(page.pageid)
+            self.fetch_sdc(self._sdc_pending[i:])
+            self._sdc_pending = []
+        try:
+            return self._sdc_cache.pop(page.pageid)
+        except KeyError:
+            pass
+        # Not preloaded (perhaps the page has been re-read), so fetch
+        # just this page.
+        self.fetch_sdc([page.pageid])
+        return self._sdc_cache.pop(page.pageid)
+    def has_sdc_geocoding(self, statements):
         return ('P625' in statements or
                 'P1259' in statements)
     def process_page(self, page):
+        while True:
+            try:
+                return self.update_page(page)
+            except PageChanged as e:
+                # That invalidates our parse tree, so start again
+                # with the new version.
+                bot.log(str(e))
+                try:
+                    page.get(force=True)
+                except pywikibot.exceptions.NoPageError:
+                    raise NotEligible("%s has been deleted" % (page,))
+                except pywikibot.exceptions.IsRedirectPageError:
+                    raise NotEligible("%s is now a redirect" % (page,))
+    def update_page(self, page):
         camera_action = None
         object_action = None
         sdc_camera_action = None
@@ -169,30 +278,26 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
         sdc_edits = {}
         revid = page.latest_revision_id
         tree = mwparserfromhell.parse(page.text)
+        # Only valid until we start modifying the tree.
+        tlindex = index_templates(tree)
         try:
-            gridimage_id = get_gridimage_id(tree)
+            gridimage_id = get_gridimage_id(tlindex)
         except ValueError as e:
             raise BadTemplate(str(e))
         except IndexError as e:
             raise BadTemplate(str(e))
             
         mapit = MapItSettings()
-        c = geodb.cursor()
-        c.execute("""
-            SELECT * FROM gridimage_base NATURAL JOIN gridimage_geo
-                          NATURAL JOIN gridimage_extra
-               WHERE gridimage_id = ?
-            """, (gridimage_id,))
-        row = c.fetchone()
+        row = self.get_geograph_row(gridimage_id)
         if row == None:
             raise NotInGeographDatabase("Geograph ID %d not in database" %
                                         (gridimage_id,))
         try:
-            old_location = get_location(tree)
+            old_location = get_location(tlindex)
         except IndexError:
             old_location = None
         try:
-            old_object_location = get_object_location(tree)
+            old_object_location = get_object_location(tlindex)
         except IndexError:
             old_object_location = None
         minor = False # May need fixing
@@ -201,7 +306,16 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
         if old_location == None and old_object_location == None:
             minor = False
             mapit.allowed = True
-            # No geocoding at all: add from Geograph
+            # No geocoding at all: add from Geograph.  Both locations
+            # might need to ask MapIt, so make those requests at the
+            # same time.  Only the HTTP requests run in parallel: the
+            # answers land in mapit_areas()'s cache, and the rest
+            # (including pyproj) happens here.
+            mapit_points = mapit_points_from_row(row)
+            if len(mapit_points) > 1:
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    list(executor.map(lambda point: mapit_areas(*point),
+                                      mapit_points))
             new_location = location_from_row(row, mapit=mapit)
             new_object_location = object_location_from_row(row, mapit=mapit)
             if new_location and new_location.get('prec').value != '1000':
@@ -213,9 +327,9 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
             oldcamparam = location_params(old_location)
             oldobjparam = location_params(old_object_location)
             if ((old_location == None or
-                 re.match(r'^geograph(-|$)', oldcamparam.get('source',''))) and
+                 is_geograph_source(oldcamparam.get('source',''))) and
                 (old_object_location == None or
-                 re.match(r'^geograph(-|$)', oldobjparam.get('source','')))):
+                 is_geograph_source(oldobjparam.get('source','')))):
                 bot.log("Old geocoding is from Geograph")
                 # Existing geocoding all from Geograph, so updating
                 # from Geograph OK if needed.
@@ -295,9 +409,19 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
             minor = False
         else:
             bot.log("Cannot add credit line")
+        if (camera_action == None and object_action == None and
+            not creditline_added):
+            # Don't bother re-serialising an unmodified tree.
+            bot.log("No changes needed")
+            return
         newtext = str(tree)
         if newtext != page.text:
-            format_params = dict(row=format_row(row))
+            summary_format = self.summary_formats[(camera_action,
+                                                   object_action)]
+            format_params = dict()
+            # A credit-line-only edit doesn't mention the row.
+            if '{row}' in summary_format or sdc_edits:
+                format_params['row'] = format_row(row)
             if camera_action == 'update':
                 format_params['camera_move'] = (
                     self.describe_move(old_location, new_location))
@@ -305,8 +429,7 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
                 format_params['object_move'] = (
                     self.describe_move(old_object_location,
                                        new_object_location))
-            summary = (self.summary_formats[(camera_action, object_action)]
-                       .format(**format_params))
+            summary = summary_format.format(**format_params)
             if creditline_added:
                 if summary == "":
                     summary = "Add credit line with title from Geograph"
@@ -323,22 +446,35 @@ class UpdateMetadataBot(SingleSiteBot, ExistingPageBot, NoRedirectPageBot):
             # revision hasn't changed.  If it has, that invalidates
             # our parse tree, and we need to start again.
             if page.latest_revision_id != revid:
-                bot.log("page has changed (%d != %d): restarting edit" %
-                        (page.latest_revision_id, revid))
-                self.process_page(page)
-                return
-            page.text = newtext
-            page.save(summary, minor=minor)
-            if sdc_edits:
+                raise PageChanged(
+                    "page has changed (%d != %d): restarting edit" %
+                    (page.latest_revision_id, revid))
+            def save_sdc(page, err):
+                # Called once the wikitext edit has been saved (or not).
+                if err != None or not sdc_edits: return
                 sdc_summary = (self.summary_formats[(sdc_camera_action,
                                                      sdc_object_action)]
                                .format(**format_params))
                 bot.log("SDC edit summary: %s" % (sdc_summary,))
-                self.site._simple_request(
-                    action='wbeditentity', format='json',
-                    id='M%d' % (page.pageid,), data=json.dumps(sdc_edits),
-                    token=self.site.tokens['csrf'], summary=sdc_summary,
-                    bot=True, baserevid=revid).submit()
+                # This runs on pywikibot's put thread, and an exception
+                # escaping from here would kill it, silently dropping
+                # every later save.
+                try:
+                    self.site._simple_request(
+                        action='wbeditentity', format='json',
+                        id='M%d' % (page.pageid,),
+                        data=json.dumps(sdc_edits),
+                        token=self.site.tokens['csrf'],
+                        summary=sdc_summary,
+                        bot=True, baserevid=revid).submit()
+                except pywikibot.exceptions.Error as e:
+                    bot.error("SDC edit of %s failed: %s" % (page, e))
+            page.text = newtext
+            # Saving is mostly waiting for the put throttle, so let
+            # pywikibot do it in the background while we get on with
+            # the next page.
+            page.save(summary, minor=minor, asynchronous=True,
+                      callback=save_sdc)
 
     def treat_page(self):
         try: